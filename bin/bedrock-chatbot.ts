@@ -8,6 +8,19 @@ new BedrockChatbotStack(app, 'BedrockChatbotStack', {
   // モデルIDをオプションで指定可能
   modelId: 'us.amazon.nova-lite-v1:0',
   //modelId: 'us.amazon.nova-micro-v1:0',
+
+  // FastAPIのエンドポイントURL (環境変数 FASTAPI_ENDPOINT_URL または -c fastApiEndpointUrl=... で指定)
+  fastApiEndpointUrl: process.env.FASTAPI_ENDPOINT_URL || app.node.tryGetContext('fastApiEndpointUrl'),
+
+  // コールドスタートを完全になくす場合はプロビジョニングされた同時実行数を指定 (課金対象)
+  //provisionedConcurrency: 1,
+
+  // 'DEBUG' を指定するとLambdaがイベントやFastAPIの応答全体をCloudWatch Logsに出力する (既定では本文の長さなどのみ)
+  //logLevel: 'DEBUG',
+
+  // 同一のメッセージと会話履歴に対する返信をウォームなLambda内でキャッシュする (既定は無効)
+  // FastAPIの応答が入力のみで決まる (同じ入力に常に同じ返信を返す) 場合に限り有効にすること
+  //responseCache: true,
   
   // 環境変数から取得したリージョンを使用、またはデフォルトとしてus-east-1を使用
   env: { 
@@ -1,187 +1,324 @@
 # lambda/index.py
-import json
+import http.client    # 切断判定用
+import json           # デバッグ出力用
 import os
-import urllib.request # urllib を使用
-import urllib.error   # エラーハンドリング用
-import socket         # タイムアウト判定用
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson         # 高速なJSONシリアライザ (bytesを直接出力)
+import urllib3        # コネクションプール付きHTTPクライアント (Lambdaランタイムに同梱)
 
 # 環境変数からFastAPIのエンドポイントURLを取得
-FASTAPI_ENDPOINT_URL = os.environ.get('https://4ea8-34-168-182-69.ngrok-free.app/')
+FASTAPI_ENDPOINT_URL = os.environ.get('FASTAPI_ENDPOINT_URL')
+if not FASTAPI_ENDPOINT_URL:
+    # 起動のたびに確認するのではなく、コールドスタート時に即座に失敗させる
+    raise EnvironmentError("FASTAPI_ENDPOINT_URL environment variable is not set.")
+
+# LOG_LEVEL=DEBUG のときのみリクエスト/レスポンス全体をログに出力する
+_DEBUG = os.environ.get('LOG_LEVEL') == 'DEBUG'
 
 # FastAPIへのリクエストタイムアウト（秒）
 REQUEST_TIMEOUT = 30 # 必要に応じて調整
 
-def lambda_handler(event, context):
-    # --- [変更なし] リクエストとユーザー情報の処理 ---
+# RESPONSE_CACHE=1 のとき、同一の入力に対する返信をウォームコンテナ内でキャッシュする
+# FastAPIの応答が入力 (メッセージと会話履歴) のみで決まる場合に限り有効にすること
+_RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE') == '1'
+RESPONSE_CACHE_SIZE = 128
+
+# 切断済みのkeep-alive接続を再利用した場合の再試行は、送信直後 (この秒数以内) に切断された場合に限る
+STALE_CONNECTION_RETRY_WINDOW = 1.0
+
+# 1リクエストでまとめて処理できるメッセージの最大数
+MAX_BATCH_SIZE = 10
+
+# 以下の定数はコールドスタート時に一度だけ構築し、各呼び出しでは参照のみ行う
+_TIMEOUT = urllib3.Timeout(connect=3, read=REQUEST_TIMEOUT)
+
+# FastAPIへのリクエストヘッダー
+_STD_HEADERS = {
+    'Content-Type': 'application/json',
+    'Accept': 'application/json' # 応答形式を指定
+}
+
+# API Gatewayへ返すレスポンスヘッダー (CORS)
+_CORS_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
+    "Access-Control-Allow-Methods": "OPTIONS,POST"
+}
+
+# レスポンスのひな形 (ヘッダーは参照で共有し、statusCode/bodyのみを差し込む)
+_RESPONSE_TEMPLATE = { "headers": _CORS_HEADERS }
+
+# プリフライト応答は本文を持たないため Content-Type を含めない
+_PREFLIGHT_RESPONSE = {
+    "statusCode": 204,
+    "headers": { k: v for k, v in _CORS_HEADERS.items() if k != "Content-Type" },
+    "body": ""
+}
+
+# コールドスタート時に一度だけ生成し、ウォーム起動間でTCP/TLS接続を再利用する
+# バッチ処理の並列リクエストも同じプールを共有する
+_HTTP = urllib3.PoolManager(num_pools=1, maxsize=MAX_BATCH_SIZE, retries=False)
+
+class BackendError(Exception):
+    """FastAPIの呼び出しに失敗したことを表す例外 (API Gatewayへ返すステータスコードを保持)"""
+
+    def __init__(self, status_code, message, detail=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.detail = detail
+
+def _post_to_fastapi(data):
+    # preload_content=False で応答ヘッダーの受信までと本文の読み取りを分け、
+    # 応答を受け取る前の切断のみを再試行の対象にする
+    started = time.monotonic()
+    try:
+        response = _HTTP.request('POST', FASTAPI_ENDPOINT_URL, body=data, headers=_STD_HEADERS,
+                                 timeout=_TIMEOUT, preload_content=False)
+    except urllib3.exceptions.ProtocolError as e:
+        # アイドル中にサーバー側で切断されたkeep-alive接続を再利用した場合は一度だけ再試行
+        # FastAPIが処理を始めた可能性がある場合 (送信から時間が経っている) は二重実行を避けて再試行しない
+        elapsed = time.monotonic() - started
+        cause = e.args[-1] if e.args else None
+        if not isinstance(cause, (http.client.RemoteDisconnected, ConnectionResetError)) \
+                or elapsed > STALE_CONNECTION_RETRY_WINDOW:
+            raise
+        print(f"Pooled connection was dropped, retrying once: {e}")
+        # 再試行を含めた合計の待ち時間が REQUEST_TIMEOUT を超えないようにする
+        retry_timeout = urllib3.Timeout(connect=_TIMEOUT.connect_timeout, read=REQUEST_TIMEOUT - elapsed)
+        response = _HTTP.request('POST', FASTAPI_ENDPOINT_URL, body=data, headers=_STD_HEADERS,
+                                 timeout=retry_timeout, preload_content=False)
+
+    # 本文の読み取り中のエラーは再試行しない (FastAPIは既に返信を生成済みのため)
     try:
+        response.read(cache_content=True)
+    finally:
+        response.release_conn()
+    return response
+
+def _parse_event(event):
+    """API Gatewayイベントからリクエストボディとユーザー情報を取り出す"""
+    raw = event.get('body')
+    if _DEBUG:
         print("Received event:", json.dumps(event))
+    else:
+        print(f"Received event: body length={len(raw or '')}")
 
-        # Cognitoユーザー情報取得など（省略）...
-        user_info = None # (前のコードから省略)
+    # Cognitoユーザー情報取得など（省略）...
+    user_info = None # (前のコードから省略)
 
-        # リクエストボディの解析
+    # リクエストボディの解析
+    # REST APIでは文字列 (またはNone) で届く。orjsonはstr/bytesどちらも直接パースできる
+    if not raw:
+        raise ValueError("Missing request body")
+    if isinstance(raw, dict):
+        # デコード済みのボディ (Lambdaコンソールからのテスト呼び出しなど)
+        body = raw
+    else:
         try:
-            if isinstance(event.get('body'), str):
-                body = json.loads(event['body'])
-            else:
-                body = event.get('body', {})
-        except json.JSONDecodeError:
-             print("Error decoding JSON body.")
-             raise ValueError("Invalid JSON format in request body")
+            body = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # リクエスト側の不正なJSONは 400 Bad Request
+            print("Error decoding JSON body.")
+            raise ValueError("Invalid JSON format in request body")
+
+    return body, user_info
 
-        if not body or 'message' not in body:
-            raise ValueError("Request body must contain a 'message' field.")
+def _parse_message(body):
+    """リクエストボディからメッセージと会話履歴を取り出す"""
+    # バッチの各項目はオブジェクト以外も届きうるため、型の誤りも 400 として扱う
+    if not isinstance(body, dict) or 'message' not in body:
+        raise ValueError("Request body must contain a 'message' field.")
 
-        message = body['message']
-        conversation_history = body.get('conversationHistory', [])
+    message = body['message']
+    conversation_history = body.get('conversationHistory', [])
 
+    if _DEBUG:
         print(f"Processing message: '{message}'")
-        print(f"Received conversation history length: {len(conversation_history)}")
+    print(f"Received conversation history length: {len(conversation_history)}")
 
-        # --- [変更箇所] urllib.request を使用してFastAPIを呼び出す ---
+    return message, conversation_history
 
-        if not FASTAPI_ENDPOINT_URL:
-            print("Error: FASTAPI_ENDPOINT_URL environment variable is not set.")
-            raise EnvironmentError("FastAPI endpoint URL is not configured.")
+def _call_backend(payload):
+    """FastAPIを呼び出し、パース済みの応答を返す (失敗時はBackendErrorを送出)"""
+    # ペイロードをJSON形式のバイト列にエンコード (orjsonはbytesを返す)
+    data = orjson.dumps(payload)
 
-        # FastAPIに送信するペイロードを作成
-        payload_to_fastapi = {
-            'message': message,
-            'conversationHistory': conversation_history
-        }
+    print(f"Calling FastAPI endpoint via urllib3: {FASTAPI_ENDPOINT_URL}")
 
-        # ヘッダー
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json' # 応答形式を指定
-        }
+    try:
+        # プール済みの接続でリクエストを実行し、レスポンスを取得
+        response = _post_to_fastapi(data)
+    except urllib3.exceptions.HTTPError as e:
+        # 接続拒否・DNS解決エラー (NewConnectionError) はurllib3ではConnectTimeoutErrorのサブクラスのため、
+        # タイムアウトとして扱わないよう先に除外する
+        if isinstance(e, urllib3.exceptions.TimeoutError) and not isinstance(e, urllib3.exceptions.NewConnectionError):
+            # 接続・読み取りのタイムアウト
+            print(f"Error calling FastAPI endpoint: Timeout Reason={e}")
+            raise BackendError(504, "The request to the backend service timed out.") # Gateway Timeout
+        # ネットワークエラー、DNS解決エラーなど
+        error_reason = str(e)
+        print(f"Error calling FastAPI endpoint: Reason={error_reason}")
+        # Bad Gateway (その他ネットワーク関連エラー)
+        raise BackendError(502, f"Failed to communicate with the backend service: {error_reason}")
 
-        # ペイロードをJSON形式のバイト列にエンコード
-        data = json.dumps(payload_to_fastapi).encode('utf-8')
+    status_code = response.status
+    response_body_bytes = response.data
+    print(f"FastAPI responded with status: {status_code}")
 
-        # urllib.request.Request オブジェクトを作成
-        req = urllib.request.Request(
-            FASTAPI_ENDPOINT_URL,
-            data=data,
-            headers=headers,
-            method='POST' # HTTPメソッドを明示的に指定
-        )
+    if status_code >= 400:
+        # FastAPIがエラー応答 (4xx, 5xx) を返した場合
+        error_body = response_body_bytes.decode('utf-8', errors='replace') # FastAPIからのエラーメッセージ本文
+        print(f"Error calling FastAPI endpoint: HTTP Status={status_code}, Detail={error_body}")
+        raise BackendError(status_code, f"Backend service error (HTTP {status_code})", error_body)
 
-        print(f"Calling FastAPI endpoint via urllib: {FASTAPI_ENDPOINT_URL}")
+    try:
+        # FastAPIからの応答 (JSON) をパース
+        fastapi_response_data = orjson.loads(response_body_bytes) # orjsonはbytesを直接パースできる
+    except orjson.JSONDecodeError:
+        # FastAPIからの応答がJSON形式でなかった場合 (502 Bad Gateway を返すのが一般的)
+        print("Error decoding JSON response from FastAPI.")
+        raise BackendError(502, "Invalid response received from backend service (not JSON).")
+    if _DEBUG:
+        print(f"Received and parsed response from FastAPI: {fastapi_response_data}")
 
-        try:
-            # リクエストを実行し、レスポンスを取得
-            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-                status_code = response.getcode()
-                response_body_bytes = response.read()
-                response_body_str = response_body_bytes.decode('utf-8')
-
-                print(f"FastAPI responded with status: {status_code}")
-                # print(f"Raw response body: {response_body_str}") # デバッグ用
-
-                if status_code >= 400:
-                     # 通常、urlopenは4xx/5xxでHTTPErrorを送出するが念のため
-                     raise urllib.error.HTTPError(FASTAPI_ENDPOINT_URL, status_code, "Error received from FastAPI", response.info(), response_body_bytes)
-
-                # FastAPIからの応答 (JSON) をパース
-                fastapi_response_data = json.loads(response_body_str)
-                print(f"Received and parsed response from FastAPI: {fastapi_response_data}")
-
-                # アシスタントの返信を取得 ('result' キーを期待)
-                assistant_response = fastapi_response_data.get('result')
-                if assistant_response is None:
-                    print("Error: 'result' key not found in FastAPI response.")
-                    raise ValueError("Invalid response format received from FastAPI.")
-
-        except urllib.error.HTTPError as e:
-            # FastAPIがエラー応答 (4xx, 5xx) を返した場合
-            status_code = e.code
-            error_body = e.read().decode('utf-8') # FastAPIからのエラーメッセージ本文
-            print(f"Error calling FastAPI endpoint: HTTP Status={status_code}, Detail={error_body}")
-            # FastAPIエラーとして処理
-            return {
-                "statusCode": status_code,
-                "headers": { "Content-Type": "application/json", "Access-Control-Allow-Origin": "*" },
-                "body": json.dumps({
-                    "success": False,
-                    "error": f"Backend service error (HTTP {status_code})",
-                    "detail": error_body # FastAPIからのエラー詳細を含める
-                })
-            }
-        except urllib.error.URLError as e:
-            # ネットワークエラー、DNS解決エラー、タイムアウトなど
-            error_reason = str(e.reason)
-            print(f"Error calling FastAPI endpoint: URLError Reason={error_reason}")
-            # タイムアウトかどうかを判定
-            if isinstance(e.reason, socket.timeout):
-                status_code = 504 # Gateway Timeout
-                error_message = "The request to the backend service timed out."
-            else:
-                status_code = 502 # Bad Gateway (その他ネットワーク関連エラー)
-                error_message = f"Failed to communicate with the backend service: {error_reason}"
-
-            return {
-                "statusCode": status_code,
-                "headers": { "Content-Type": "application/json", "Access-Control-Allow-Origin": "*" },
-                "body": json.dumps({
-                    "success": False,
-                    "error": error_message
-                })
-            }
-        except json.JSONDecodeError:
-            # FastAPIからの応答がJSON形式でなかった場合
-             print("Error decoding JSON response from FastAPI.")
-             # 502 Bad Gateway を返すのが一般的
-             return {
-                 "statusCode": 502,
-                 "headers": { "Content-Type": "application/json", "Access-Control-Allow-Origin": "*" },
-                 "body": json.dumps({
-                     "success": False,
-                     "error": "Invalid response received from backend service (not JSON)."
-                 })
-             }
-
-        # --- [変更箇所] 会話履歴の更新 (ロジック自体は変更なし) ---
-        messages = conversation_history.copy()
-        messages.append({ "role": "user", "content": message })
-        messages.append({ "role": "assistant", "content": assistant_response })
-
-        # --- [変更なし] 成功レスポンスの返却 ---
-        print("Successfully processed request using urllib.")
-        return {
-            "statusCode": 200,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-                "Access-Control-Allow-Methods": "OPTIONS,POST"
-            },
-            "body": json.dumps({
-                "success": True,
-                "response": assistant_response,
-                "conversationHistory": messages
-            })
-        }
-
-    # --- [変更なし] 全体的なエラーハンドリング ---
-    except (ValueError, EnvironmentError, Exception) as error:
-        error_type = type(error).__name__
-        error_message = str(error)
-        print(f"Error ({error_type}): {error_message}")
-        status_code = 400 if isinstance(error, (ValueError, json.JSONDecodeError)) else 500
-        # CORSヘッダーをエラー応答にも含める
-        headers = {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-            "Access-Control-Allow-Methods": "OPTIONS,POST"
-        }
-        return {
-            "statusCode": status_code,
-            "headers": headers,
-            "body": json.dumps({
-                "success": False,
-                "error": error_message,
-                "errorType": error_type
-            })
-        }
+    return fastapi_response_data
+
+def _generate(message, conversation_history):
+    """FastAPIを呼び出し、アシスタントの返信を取得する"""
+    fastapi_response_data = _call_backend({
+        'message': message,
+        'conversationHistory': conversation_history
+    })
+
+    # アシスタントの返信を取得 ('result' キーを期待)
+    assistant_response = fastapi_response_data.get('result') if isinstance(fastapi_response_data, dict) else None
+    if assistant_response is None:
+        # バックエンド側の応答形式の誤りは 502 Bad Gateway
+        print("Error: 'result' key not found in FastAPI response.")
+        raise BackendError(502, "Invalid response format received from FastAPI.")
+    return assistant_response
+
+@lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+def _generate_cached(message, history_key):
+    """_generate のキャッシュ付き版 (例外はキャッシュされない)"""
+    conversation_history = [{ "role": role, "content": content } for role, content in history_key]
+    return _generate(message, conversation_history)
+
+def _history_cache_key(conversation_history):
+    """会話履歴をキャッシュキー用のタプルに変換する (role/content以外を含む場合はNone)"""
+    try:
+        history_key = tuple((item['role'], item['content']) for item in conversation_history if len(item) == 2)
+        hash(history_key)
+    except (KeyError, TypeError):
+        return None
+    if len(history_key) != len(conversation_history):
+        return None
+    return history_key
+
+def _chat(body):
+    """1件のメッセージをFastAPIで処理し、成功時のレスポンス内容を返す"""
+    message, conversation_history = _parse_message(body)
+
+    assistant_response = None
+    if _RESPONSE_CACHE:
+        history_key = _history_cache_key(conversation_history)
+        if history_key is not None and isinstance(message, str):
+            assistant_response = _generate_cached(message, history_key)
+    if assistant_response is None:
+        assistant_response = _generate(message, conversation_history)
+
+    # 会話履歴の更新
+    messages = [
+        *conversation_history,
+        { "role": "user", "content": message },
+        { "role": "assistant", "content": assistant_response }
+    ]
+
+    print("Successfully processed request using urllib3.")
+    return {
+        "success": True,
+        "response": assistant_response,
+        "conversationHistory": messages
+    }
+
+def _error_payload(error):
+    """例外をステータスコードとエラー内容に変換する"""
+    if isinstance(error, BackendError):
+        error_payload = { "success": False, "error": str(error) }
+        if error.detail is not None:
+            error_payload["detail"] = error.detail # FastAPIからのエラー詳細を含める
+        return error.status_code, error_payload
+
+    error_type = type(error).__name__
+    error_message = str(error)
+    print(f"Error ({error_type}): {error_message}")
+    status_code = 400 if isinstance(error, ValueError) else 500
+    return status_code, {
+        "success": False,
+        "error": error_message,
+        "errorType": error_type
+    }
+
+def _chat_batch_item(body):
+    """バッチ内の1件を処理する (失敗しても例外を送出せず、項目ごとのステータスを返す)"""
+    try:
+        return { "statusCode": 200, **_chat(body) }
+    except Exception as error:
+        status_code, error_payload = _error_payload(error)
+        return { "statusCode": status_code, **error_payload }
+
+def _chat_batch(batch):
+    """複数のメッセージを並列にFastAPIへ送信し、項目ごとの結果を返す"""
+    if not batch:
+        raise ValueError("'requests' must contain at least one item.")
+    if len(batch) > MAX_BATCH_SIZE:
+        raise ValueError(f"'requests' must not contain more than {MAX_BATCH_SIZE} items.")
+
+    print(f"Processing batch of {len(batch)} requests")
+    with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+        results = list(pool.map(_chat_batch_item, batch))
+
+    return {
+        "success": True,
+        "responses": results
+    }
+
+def _format_response(status_code, payload):
+    """CORSヘッダー付きのAPI Gatewayレスポンスを組み立てる"""
+    return _RESPONSE_TEMPLATE | { "statusCode": status_code, "body": orjson.dumps(payload).decode('utf-8') }
+
+def _error_response(error):
+    """例外をCORSヘッダー付きのエラーレスポンスに変換する"""
+    return _format_response(*_error_payload(error))
+
+def lambda_handler(event, context):
+    # EventBridgeのウォームアップ呼び出しは初期化済みの実行環境を維持するだけで即座に返す
+    if event.get('warmup'):
+        return {'statusCode': 200, 'body': 'warm'}
+
+    # CORSプリフライト (OPTIONS) はボディを解析せず、バックエンドも呼び出さずに返す
+    # 本スタックではAPI GatewayのdefaultCorsPreflightOptionsが応答するためここには届かないが、
+    # OPTIONSを関数へ転送する構成 (プロキシ統合やHTTP APIなど) のためのガード
+    method = event.get('httpMethod') or event.get('requestContext', {}).get('http', {}).get('method')
+    if method == 'OPTIONS':
+        return _PREFLIGHT_RESPONSE
+
+    try:
+        body, user_info = _parse_event(event)
+
+        # {"requests": [...]} 形式の場合はまとめて処理する
+        batch = body.get('requests') if isinstance(body, dict) else None
+        if isinstance(batch, list):
+            # 単一メッセージとバッチの両方を指定した場合、どちらを処理すべきか曖昧なため拒否する
+            if 'message' in body:
+                raise ValueError("Request body must contain either 'message' or 'requests', not both.")
+            return _format_response(200, _chat_batch(batch))
+
+        return _format_response(200, _chat(body))
+
+    # --- 全体的なエラーハンドリング ---
+    except Exception as error:
+        return _error_response(error)
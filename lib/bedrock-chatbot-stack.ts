@@ -10,11 +10,19 @@ import * as cloudfront from 'aws-cdk-lib/aws-cloudfront';
 import * as origins from 'aws-cdk-lib/aws-cloudfront-origins';
 import * as cognito from 'aws-cdk-lib/aws-cognito';
 import * as path from 'path';
+import * as fs from 'fs';
+import { execSync } from 'child_process';
 import * as cr from 'aws-cdk-lib/custom-resources';
 import * as logs from 'aws-cdk-lib/aws-logs';
+import * as events from 'aws-cdk-lib/aws-events';
+import * as targets from 'aws-cdk-lib/aws-events-targets';
 
 export interface BedrockChatbotStackProps extends cdk.StackProps {
   modelId?: string;
+  fastApiEndpointUrl?: string;
+  provisionedConcurrency?: number;
+  logLevel?: string;
+  responseCache?: boolean;
 }
 
 export class BedrockChatbotStack extends cdk.Stack {
@@ -23,6 +31,12 @@ export class BedrockChatbotStack extends cdk.Stack {
 
     const modelId = props?.modelId || 'us.amazon.nova-lite-v1:0';
 
+    // チャットLambdaが呼び出すFastAPIのエンドポイントURL (未指定の場合はLambdaが起動時に失敗するため、合成時にエラーとする)
+    const fastApiEndpointUrl = props?.fastApiEndpointUrl;
+    if (!fastApiEndpointUrl) {
+      throw new Error('fastApiEndpointUrl is required (set FASTAPI_ENDPOINT_URL or -c fastApiEndpointUrl=...)');
+    }
+
     // Cognito User Poolの作成
     const userPool = new cognito.UserPool(this, 'ChatbotUserPool', {
       userPoolName: 'chatbot-user-pool',
@@ -152,12 +166,55 @@ export class BedrockChatbotStack extends cdk.Stack {
     const chatFunction = new lambda.Function(this, 'ChatFunction', {
       runtime: lambda.Runtime.PYTHON_3_10,
       handler: 'index.lambda_handler',
-      code: lambda.Code.fromAsset(path.join(__dirname, '../lambda')),
+      // requirements.txt の依存関係 (orjson など) とハンドラーのみをLambdaパッケージに同梱
+      // boto3/botocore/urllib3 はLambdaランタイムに含まれるため同梱しない
+      // 実行環境は読み取り専用で .pyc を書き込めないため、ソースを確認しないバイトコードを事前生成する
+      // (Dockerでのバンドルでは常に、ローカルでのバンドルでは python3.10 がある場合のみ)
+      code: lambda.Code.fromAsset(path.join(__dirname, '../lambda'), {
+        bundling: {
+          // Dockerがない環境向け: Lambdaランタイム (x86_64 / Python 3.10) 用のwheelをローカルのpipで取得する
+          // バイトコードはランタイムと同じ python3.10 がある場合のみ事前生成する (ない場合は警告を出して .py のみを同梱)
+          local: {
+            tryBundle(outputDir: string) {
+              const lambdaDir = path.join(__dirname, '../lambda');
+              try {
+                execSync([
+                  'pip3 install --no-cache-dir -r requirements.txt -t', JSON.stringify(outputDir),
+                  '--platform manylinux2014_x86_64 --implementation cp --python-version 3.10 --only-binary=:all:',
+                ].join(' '), { cwd: lambdaDir, stdio: 'inherit' });
+              } catch (error) {
+                // ローカルで失敗した場合はDockerでのバンドルにフォールバック
+                return false;
+              }
+              fs.copyFileSync(path.join(lambdaDir, 'index.py'), path.join(outputDir, 'index.py'));
+              try {
+                execSync(`python3.10 -m compileall -q --invalidation-mode unchecked-hash ${JSON.stringify(outputDir)}`, { stdio: 'inherit' });
+              } catch (error) {
+                console.warn('python3.10 not found: Lambda bundle is not precompiled (cold starts will compile index.py)');
+              }
+              return true;
+            },
+          },
+          image: lambda.Runtime.PYTHON_3_10.bundlingImage,
+          command: [
+            'bash', '-c', [
+              'pip install --no-cache-dir -r requirements.txt -t /asset-output',
+              'cp index.py /asset-output',
+              'python -m compileall -q --invalidation-mode unchecked-hash /asset-output',
+            ].join(' && '),
+          ],
+        },
+      }),
       timeout: cdk.Duration.seconds(30),
       memorySize: 128,
       role: lambdaRole,
       environment: {
         MODEL_ID: modelId,
+        FASTAPI_ENDPOINT_URL: fastApiEndpointUrl,
+        // 'DEBUG' の場合のみリクエスト/レスポンス全体をログに出力する
+        ...(props?.logLevel ? { LOG_LEVEL: props.logLevel } : {}),
+        // 同一の入力に対する返信のキャッシュ (FastAPIの応答が入力のみで決まる場合に限り有効にする)
+        ...(props?.responseCache ? { RESPONSE_CACHE: '1' } : {}),
       },
     });
 
@@ -166,6 +223,25 @@ export class BedrockChatbotStack extends cdk.Stack {
     const cfnLambdaRole = lambdaRole.node.defaultChild as iam.CfnRole;
     cfnChatFunction.addDependsOn(cfnLambdaRole);
 
+    // プロビジョニングされた同時実行数は公開バージョンのエイリアスに設定する
+    // 公開バージョンの環境変数 (FASTAPI_ENDPOINT_URL など) は作成時に固定されるため、変更はコンソールではなく cdk deploy で行う
+    // 未指定の場合は従来どおり $LATEST を呼び出す
+    const chatTarget: lambda.IFunction = props?.provisionedConcurrency
+      ? chatFunction.addAlias('live', {
+          provisionedConcurrentExecutions: props.provisionedConcurrency,
+        })
+      : chatFunction;
+
+    // コールドスタートを避けるため、5分ごとにウォームアップイベントで関数を呼び出す
+    new events.Rule(this, 'ChatFunctionWarmupRule', {
+      schedule: events.Schedule.rate(cdk.Duration.minutes(5)),
+      targets: [
+        new targets.LambdaFunction(chatTarget, {
+          event: events.RuleTargetInput.fromObject({ warmup: true }),
+        }),
+      ],
+    });
+
     // API Gateway with Cognito Authorizer
     const api = new apigateway.RestApi(this, 'ChatbotApi', {
       restApiName: 'Bedrock Chatbot API',
@@ -184,7 +260,7 @@ export class BedrockChatbotStack extends cdk.Stack {
     });
 
     const chatResource = api.root.addResource('chat');
-    chatResource.addMethod('POST', new apigateway.LambdaIntegration(chatFunction), {
+    chatResource.addMethod('POST', new apigateway.LambdaIntegration(chatTarget), {
       authorizer,
       authorizationType: apigateway.AuthorizationType.COGNITO,
     });